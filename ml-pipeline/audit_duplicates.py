@@ -30,7 +30,7 @@ def audit_collection(name: str, timestamp_field: str = "timestamp"):
     print(f"Auditing: {name}")
     print('='*50)
     
-    records = fetch_records(name)
+    records = fetch_records(name, fields=f"id,user,{timestamp_field},value_mgdl,steps")
     
     # Group by (user, timestamp)
     groups = defaultdict(list)
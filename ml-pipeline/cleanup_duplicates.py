@@ -19,8 +19,7 @@ print(f"🔗 Using PocketBase at: {os.getenv('PB_URL')}")
 
 sys.path.insert(0, "nutrition-pipeline")
 
-from pb_client import fetch_records, get_token
-import requests
+from pb_client import fetch_records, session
 
 PB_URL = os.getenv("PB_URL")
 
@@ -28,8 +27,7 @@ PB_URL = os.getenv("PB_URL")
 def delete_record(collection: str, record_id: str):
     """Delete a single record from PocketBase."""
     url = f"{PB_URL}/api/collections/{collection}/records/{record_id}"
-    headers = {"Authorization": f"Bearer {get_token()}"}
-    r = requests.delete(url, headers=headers)
+    r = session().delete(url)  # pooled keep-alive connection, cached token
     return r.status_code in [200, 204, 404]  # 404 = already deleted, treat as success
 
 
@@ -42,7 +40,7 @@ def cleanup_collection(name: str, timestamp_field: str = "timestamp", dry_run: b
     print(f"Cleaning: {name}")
     print('='*50)
     
-    records = fetch_records(name)
+    records = fetch_records(name, fields=f"id,user,{timestamp_field},created")
     
     # Group by (user, timestamp)
     groups = defaultdict(list)
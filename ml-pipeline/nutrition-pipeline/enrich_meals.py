@@ -1,23 +1,22 @@
-from pb_client import fetch_unparsed_meals, insert_ingredient, get_token
-from parser_gpt import parse_ingredients, parse_ingredients_from_image
-from lookup_usda import usda_lookup
-import os
+from pb_client import (
+    fetch_unparsed_meals, insert_ingredients_bulk, get_token, PB_URL,
+)
+from parser_gpt import (
+    parse_ingredients, parse_ingredients_batch, parse_ingredients_offline, parse_ingredients_from_image,
+    BATCH_MAX_WAIT_S,
+)
+from lookup_usda import usda_lookup_many
+from food_units import BANNED_INGREDIENTS, estimate_grams, calculate_macros
 import argparse
+import logging
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, as_completed, wait
+from itertools import islice
 
-# Items to skip - either too vague or non-food items from image parsing
-BANNED_INGREDIENTS = {
-    # Vague meal descriptors
-    "smoothie", "salad", "sandwich", "bowl", "dish", "meal", "food", "snack",
-    "breakfast", "lunch", "dinner", "unknown item", "unknown", "item",
-    "serving", "1 serving", "portion",
-    # Kitchen items that slip through from images
-    "knife", "fork", "spoon", "plate", "napkin", "cup", "glass", "table",
-    "cutting board", "pan", "pot", "utensil", "container", "wrapper",
-    "plate with food", "bowl with food", "dish with food",
-    # Household items GPT sometimes sees (exact matches only)
-    "rug", "round rug", "grey round rug", "thermo mug", 
-    "counter", "countertop", "kitchen", "placemat", "towel",
-}
+# Per-meal progress goes through logging so it can be silenced (see --verbose)
+log = logging.getLogger("enrich")
+
+# Meal texts sent to GPT per parse request
+PARSE_BATCH_SIZE = 20
 
 
 def normalize_quantity(ing):
@@ -27,67 +26,129 @@ def normalize_quantity(ing):
     return ing
 
 
-# Unit to grams conversion (approximate)
-UNIT_TO_GRAMS = {
-    # Weight
-    "oz": 28.35,
-    "g": 1,
-    "grams": 1,
-    "gram": 1,
-    # Volume
-    "cup": 150,      # varies by food, conservative estimate
-    "cups": 150,
-    "tbsp": 15,
-    "tablespoon": 15,
-    "tsp": 5,
-    "teaspoon": 5,
-    # Count - smaller portions to avoid overestimating
-    "piece": 50,
-    "pieces": 50,
-    "slice": 20,
-    "slices": 20,
-    "serving": 100,
-    "link": 50,      # sausage link
-    "links": 50,
-    # Eggs
-    "eggs": 50,
-    "egg": 50,
-    # Supplements - no macros
-    "pill": 0,
-    "pills": 0,
-    "capsule": 0,
-    "capsules": 0,
-    "l": 0,
-}
-
-
-def estimate_grams(quantity: float, unit: str) -> float:
-    """Estimate weight in grams from quantity and unit."""
-    if not quantity:
-        quantity = 1
-    if not unit:
-        return quantity * 80  # default to smaller portion
-    
-    unit_lower = unit.lower().strip()
-    multiplier = UNIT_TO_GRAMS.get(unit_lower, 80)  # default to 80g if unknown unit
-    return quantity * multiplier
+def _process_meal(meal, skip_usda):
+    """Parse, look up and store one meal. Returns (processed, errors)."""
+    errors = 0
+    text = (meal.get("text") or "").strip()
+    image_field = meal.get("image")
 
+    # Skip only if both missing
+    if not text and not image_field:
+        return 0, 0
 
-def calculate_macros(macros_per_100g: dict, grams: float) -> dict:
-    """Scale macros from per-100g to actual amount consumed."""
-    if not macros_per_100g or grams <= 0:
-        return {"calories": 0, "protein": 0, "carbs": 0, "fat": 0}
-    
-    scale = grams / 100.0
-    return {
-        "calories": round(macros_per_100g.get("calories", 0) * scale, 1),
-        "protein": round(macros_per_100g.get("protein", 0) * scale, 1),
-        "carbs": round(macros_per_100g.get("carbs", 0) * scale, 1),
-        "fat": round(macros_per_100g.get("fat", 0) * scale, 1),
-    }
+    log.info("%s", "=" * 50)
+    log.info("Meal: %s", text or "[Image only]")
+    log.info("ID: %s | Time: %s", meal["id"], meal.get("timestamp", "N/A"))
+
+    # Step 1: GPT parsing (get_token is cached until near JWT expiry, so
+    # asking per meal is free and keeps long runs authenticated)
+    try:
+        if text and image_field:
+            log.info("🧠 Parsing both text + image...")
+            ingredients_text = parse_ingredients(text)
+            ingredients_image = parse_ingredients_from_image(meal, PB_URL, get_token())
+            parsed = ingredients_text + ingredients_image
+        elif text:
+            log.info("🧠 Parsing text...")
+            parsed = parse_ingredients(text)
+        elif image_field:
+            log.info("🧠 Parsing image...")
+            parsed = parse_ingredients_from_image(meal, PB_URL, get_token())
+        else:
+            parsed = []
+    except Exception as e:
+        log.error("❌ GPT parsing failed: %s", e)
+        return 0, 1
+
+    log.info("→ Parsed %d ingredients: %s", len(parsed), [i["name"] for i in parsed])
+
+    # Step 2: Drop banned items, normalize the rest
+    to_store = []
+    names_lower = []
+    for ing in parsed:
+        name_lower = ing["name"].lower()
+        if name_lower in BANNED_INGREDIENTS:
+            log.info("⏭️  Skipped banned: %s", ing["name"])
+            continue
+        to_store.append(normalize_quantity(ing))
+        names_lower.append(name_lower)
+
+    # Step 3: USDA lookups for the whole meal run concurrently (optional for MVP)
+    if skip_usda:
+        lookups = [None] * len(to_store)
+    else:
+        lookups = usda_lookup_many(names_lower)
+
+    # Step 4: Build ingredient records
+    meal_id = meal["id"]
+    meal_timestamp = meal.get("timestamp")
+    rows = []
+    for ing, usda in zip(to_store, lookups):
+        macros = None
+        
+        if isinstance(usda, Exception):
+            log.warning("⚠️  USDA lookup failed for %s: %s", ing["name"], usda)
+            usda = None
+        else:
+            try:
+                if usda and usda.get("macros_per_100g"):
+                    # Calculate actual macros based on quantity eaten
+                    grams = estimate_grams(ing.get("quantity", 1), ing.get("unit", "serving"))
+                    macros = calculate_macros(usda["macros_per_100g"], grams)
+                    log.info("   📊 %s: %.0fg → %.0f cal, %.0fg protein",
+                             ing["name"], grams, macros["calories"], macros["protein"])
+            except Exception as e:
+                log.warning("⚠️  Macro calculation failed for %s: %s", ing["name"], e)
+        
+        # Only build the zero placeholder when no USDA macros were computed
+        if macros is None:
+            macros = {"calories": 0, "protein": 0, "carbs": 0, "fat": 0}
+
+        # Get category from GPT response (default to "food" for backward compatibility)
+        category = ing.get("category", "food")
+        
+        ingredient = {
+            "mealId": meal_id,
+            "name": ing["name"],
+            "quantity": ing.get("quantity"),
+            "unit": ing.get("unit"),
+            "category": category,
+            "source": "usda" if usda else "gpt",
+            "usdaCode": usda["usdaCode"] if usda else None,
+            "nutrition": usda.get("nutrition", []) if usda else [],
+            "macros": macros,
+            "rawGPT": ing,
+            # The nutrient array is already stored in "nutrition"; don't
+            # serialize and send it a second time inside rawUSDA
+            "rawUSDA": {k: v for k, v in usda.items() if k != "nutrition"} if usda else {},
+            "timestamp": meal_timestamp,
+        }
 
+        rows.append(ingredient)
 
-def enrich_meals(skip_usda=False, limit=None, since_date=None):
+    # Step 5: Store the meal's rows. insert_ingredients_bulk already retries a
+    # rejected batch row by row and reports rows that still failed; sending
+    # them again here would duplicate whatever it had stored
+    try:
+        results, failed = insert_ingredients_bulk(rows) if rows else ([], [])
+    except Exception as e:
+        # The batch request itself didn't complete; it may or may not have
+        # committed, so don't risk inserting the rows twice
+        log.error("❌ Failed to store ingredients for meal %s: %s", meal_id, e)
+        return 1, errors + len(rows)
+
+    for row, e in failed:
+        log.error("❌ Failed to insert %s: %s", row["name"], e)
+        errors += 1
+
+    for result in results:
+        log.info("✅ %s (%s %s)", result.get("name"), result.get("quantity"), result.get("unit"))
+
+    return 1, errors
+
+
+def enrich_meals(skip_usda=False, limit=None, since_date=None, workers=8, batch_api=False,
+                 batch_max_wait=BATCH_MAX_WAIT_S):
     """
     Parse meals and store ingredients.
     
@@ -95,108 +156,69 @@ def enrich_meals(skip_usda=False, limit=None, since_date=None):
         skip_usda: If True, skip USDA nutrition lookup (faster, Level 1 MVP)
         limit: Max number of meals to process (useful for testing)
         since_date: Only process meals after this date (ISO format, e.g. '2026-01-24')
+        workers: Number of meals processed concurrently
+        batch_api: Parse meal texts through the OpenAI Batch API first (half
+            price, but may take hours - for large backfills)
+        batch_max_wait: Seconds to wait on the Batch API before parsing the
+            remaining texts per meal instead
     """
     meals = fetch_unparsed_meals(since_date=since_date)
     
     if limit:
-        meals = meals[:limit]
+        meals = islice(meals, limit)
         print(f"🔢 Limited to {limit} meals")
     
-    if not meals:
-        print("✨ All meals already parsed!")
-        return
-    
-    PB_URL = os.getenv("PB_URL", "http://127.0.0.1:8090")
-    token = get_token()
+    if batch_api:
+        # The batch has to be complete before any meal is processed
+        meals = list(meals)
+        texts = [m["text"].strip() for m in meals if (m.get("text") or "").strip()]
+        if texts:
+            parse_ingredients_offline(texts, max_wait=batch_max_wait)
+        meals = iter(meals)
     
     processed = 0
     errors = 0
 
-    for meal in meals:
-        text = (meal.get("text") or "").strip()
-        image_field = meal.get("image")
-
-        # Skip only if both missing
-        if not text and not image_field:
-            continue
+    # Meals are independent and bound on GPT/USDA/PocketBase latency, so run
+    # several at once (the GIL is released while waiting on the network).
+    # Meals stream in page by page; once ~2x `workers` meals are in flight,
+    # finished ones are tallied before the next group is fetched and parsed,
+    # so memory stays bounded however long the backlog is.
+    max_pending = 2 * workers
+    submitted = 0
+    pending = set()
 
-        print(f"\n{'='*50}")
-        print(f"Meal: {text or '[Image only]'}")
-        print(f"ID: {meal['id']} | Time: {meal.get('timestamp', 'N/A')}")
-
-        # Step 1: GPT parsing
-        try:
-            if text and image_field:
-                print("🧠 Parsing both text + image...")
-                ingredients_text = parse_ingredients(text)
-                ingredients_image = parse_ingredients_from_image(meal, PB_URL, token)
-                parsed = ingredients_text + ingredients_image
-            elif text:
-                print("🧠 Parsing text...")
-                parsed = parse_ingredients(text)
-            elif image_field:
-                print("🧠 Parsing image...")
-                parsed = parse_ingredients_from_image(meal, PB_URL, token)
-            else:
-                parsed = []
-        except Exception as e:
-            print(f"❌ GPT parsing failed: {e}")
-            errors += 1
-            continue
+    def _tally(done):
+        nonlocal processed, errors
+        for future in done:
+            meal_processed, meal_errors = future.result()
+            processed += meal_processed
+            errors += meal_errors
 
-        print(f"→ Parsed {len(parsed)} ingredients: {[i['name'] for i in parsed]}")
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while True:
+            while len(pending) >= max_pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                _tally(done)
 
-        # Step 2: Store ingredients
-        for ing in parsed:
-            if ing["name"].lower() in BANNED_INGREDIENTS:
-                print(f"⏭️  Skipped banned: {ing['name']}")
-                continue
-
-            ing = normalize_quantity(ing)
-            
-            # USDA lookup (optional for MVP)
-            usda = None
-            macros = {"calories": 0, "protein": 0, "carbs": 0, "fat": 0}
-            
-            if not skip_usda:
+            batch = list(islice(meals, PARSE_BATCH_SIZE))
+            if not batch:
+                break
+            # One GPT call parses the whole batch's texts; _process_meal's
+            # parse_ingredients then hits the parser cache. Texts the batch
+            # couldn't parse stay uncached and are parsed by the workers.
+            texts = [m["text"].strip() for m in batch if (m.get("text") or "").strip()]
+            if texts:
                 try:
-                    usda = usda_lookup(ing["name"])
-                    if usda and usda.get("macros_per_100g"):
-                        # Calculate actual macros based on quantity eaten
-                        grams = estimate_grams(ing.get("quantity", 1), ing.get("unit", "serving"))
-                        macros = calculate_macros(usda["macros_per_100g"], grams)
-                        print(f"   📊 {ing['name']}: {grams:.0f}g → {macros['calories']:.0f} cal, {macros['protein']:.0f}g protein")
+                    parse_ingredients_batch(texts, batch_size=PARSE_BATCH_SIZE)
                 except Exception as e:
-                    print(f"⚠️  USDA lookup failed for {ing['name']}: {e}")
-            
-            meal_timestamp = meal.get("timestamp")
-
-            # Get category from GPT response (default to "food" for backward compatibility)
-            category = ing.get("category", "food")
-            
-            ingredient = {
-                "mealId": meal["id"],
-                "name": ing["name"],
-                "quantity": ing.get("quantity"),
-                "unit": ing.get("unit"),
-                "category": category,
-                "source": "usda" if usda else "gpt",
-                "usdaCode": usda["usdaCode"] if usda else None,
-                "nutrition": usda.get("nutrition", []) if usda else [],
-                "macros": macros,
-                "rawGPT": ing,
-                "rawUSDA": usda or {},
-                "timestamp": meal_timestamp,
-            }
-
-            try:
-                result = insert_ingredient(ingredient)
-                print(f"✅ {result['name']} ({ing.get('quantity')} {ing.get('unit')})")
-            except Exception as e:
-                print(f"❌ Failed to insert {ing['name']}: {e}")
-                errors += 1
-        
-        processed += 1
+                    log.warning("⚠️  Batch parse failed (%s), parsing per meal", e)
+            pending.update(pool.submit(_process_meal, meal, skip_usda) for meal in batch)
+            submitted += len(batch)
+        if not submitted:
+            print("✨ All meals already parsed!")
+            return
+        _tally(as_completed(pending))
 
     print(f"\n{'='*50}")
     print(f"🏁 Done! Processed {processed} meals, {errors} errors")
@@ -212,13 +234,27 @@ if __name__ == "__main__":
                         help="Only process meals after this date (e.g. 2026-01-24)")
     parser.add_argument("--last-week", action="store_true",
                         help="Only process meals from the last 7 days")
+    parser.add_argument("--workers", type=int, default=8,
+                        help="Meals to process concurrently (default 8)")
+    parser.add_argument("--verbose", "-v", action="store_true",
+                        help="Log per-meal and per-ingredient progress")
+    parser.add_argument("--batch", action="store_true",
+                        help="Parse texts via the OpenAI Batch API first (cheaper, slow; for backfills)")
+    parser.add_argument("--batch-max-wait", type=float, default=BATCH_MAX_WAIT_S / 3600,
+                        help="Hours to wait on the --batch job before parsing per meal (default 24)")
     args = parser.parse_args()
     
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING,
+                        format="%(message)s")
+    
     # Calculate date for --last-week
     since_date = args.since
     if args.last_week:
-        from datetime import datetime, timedelta
-        since_date = (datetime.now() - timedelta(days=7)).strftime("%Y-%m-%d")
+        from datetime import datetime, timedelta, timezone
+        # PocketBase timestamps are UTC, so take the cutoff in UTC too
+        since_date = (datetime.now(timezone.utc) - timedelta(days=7)).strftime("%Y-%m-%d")
         print(f"📅 --last-week: processing since {since_date}")
     
-    enrich_meals(skip_usda=args.skip_usda, limit=args.limit, since_date=since_date)
\ No newline at end of file
+    enrich_meals(skip_usda=args.skip_usda, limit=args.limit, since_date=since_date,
+                 workers=args.workers, batch_api=args.batch,
+                 batch_max_wait=args.batch_max_wait * 3600)
\ No newline at end of file
@@ -0,0 +1,98 @@
+"""
+Shared unit conversion and macro helpers for the nutrition pipeline.
+
+enrich_meals, backfill_macros and debug_day all estimate grams and scale
+per-100g macros; keeping the tables here means they agree (and importing
+them doesn't pull in the GPT client).
+"""
+
+import functools
+from types import MappingProxyType
+
+# Items to skip - either too vague or non-food items from image parsing
+# (lowercase, matched against the lowercased ingredient name)
+BANNED_INGREDIENTS = frozenset({
+    # Vague meal descriptors
+    "smoothie", "salad", "sandwich", "bowl", "dish", "meal", "food", "snack",
+    "breakfast", "lunch", "dinner", "unknown item", "unknown", "item",
+    "serving", "1 serving", "portion",
+    # Kitchen items that slip through from images
+    "knife", "fork", "spoon", "plate", "napkin", "cup", "glass", "table",
+    "cutting board", "pan", "pot", "utensil", "container", "wrapper",
+    "plate with food", "bowl with food", "dish with food",
+    # Household items GPT sometimes sees (exact matches only)
+    "rug", "round rug", "grey round rug", "thermo mug", 
+    "counter", "countertop", "kitchen", "placemat", "towel",
+})
+
+
+# Unit to grams conversion (approximate). Read-only: _grams_per_unit caches
+# lookups against it.
+UNIT_TO_GRAMS = MappingProxyType({
+    # Weight
+    "oz": 28.35,
+    "g": 1,
+    "grams": 1,
+    "gram": 1,
+    # Volume
+    "cup": 150,      # varies by food, conservative estimate
+    "cups": 150,
+    "tbsp": 15,
+    "tablespoon": 15,
+    "tsp": 5,
+    "teaspoon": 5,
+    # Count - smaller portions to avoid overestimating
+    "count": 50,     # GPT's unit for counted items
+    "piece": 50,
+    "pieces": 50,
+    "slice": 20,
+    "slices": 20,
+    "serving": 100,
+    "link": 50,      # sausage link
+    "links": 50,
+    # Eggs
+    "eggs": 50,
+    "egg": 50,
+    # Supplements - no macros
+    "pill": 0,
+    "pills": 0,
+    "capsule": 0,
+    "capsules": 0,
+    "l": 0,
+})
+
+
+@functools.lru_cache(maxsize=256)
+def _grams_per_unit(unit: str) -> float:
+    """Grams per unit; case/whitespace normalization runs once per spelling."""
+    key = unit.lower().strip()
+    grams = UNIT_TO_GRAMS.get(key)
+    if grams is None and key.endswith("s") and len(key) > 3:
+        # Plural of a listed unit ("tbsps", "tsps"); short strings like "ls"
+        # or "gs" aren't plurals and keep the unknown-unit default
+        grams = UNIT_TO_GRAMS.get(key[:-1])
+    return 80 if grams is None else grams  # default to 80g if unknown unit
+
+
+def estimate_grams(quantity: float, unit: str) -> float:
+    """Estimate weight in grams from quantity and unit."""
+    if not quantity:
+        quantity = 1
+    if not unit:
+        return quantity * 80  # default to smaller portion
+    
+    return quantity * _grams_per_unit(unit)
+
+
+def calculate_macros(macros_per_100g: dict, grams: float) -> dict:
+    """Scale macros from per-100g to actual amount consumed."""
+    if not macros_per_100g or grams <= 0:
+        return {"calories": 0, "protein": 0, "carbs": 0, "fat": 0}
+    
+    scale = grams / 100.0
+    return {
+        "calories": round(macros_per_100g.get("calories", 0) * scale, 1),
+        "protein": round(macros_per_100g.get("protein", 0) * scale, 1),
+        "carbs": round(macros_per_100g.get("carbs", 0) * scale, 1),
+        "fat": round(macros_per_100g.get("fat", 0) * scale, 1),
+    }
@@ -1,11 +1,62 @@
 import os
+import re
+import functools
+import logging
+import threading
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 
+import usda_cache
+
 load_dotenv()   # make sure env vars are loaded
 
+# Lookups run on worker threads; progress goes through logging so callers
+# decide what's shown (enrich_meals --verbose)
+log = logging.getLogger("usda")
+
 USDA_KEY = os.getenv("USDA_KEY")
+if not USDA_KEY:
+    log.warning("USDA_KEY is not set; uncached lookups will fail")
 USDA_URL = "https://api.nal.usda.gov/fdc/v1/foods/search"
+USDA_TIMEOUT_S = (3, 15)  # (connect, read)
+
+# Cap concurrent USDA requests across all callers: enrich_meals runs several
+# meals at once, each fanning out through usda_lookup_many
+USDA_MAX_CONCURRENCY = 8
+_usda_slots = threading.Semaphore(USDA_MAX_CONCURRENCY)
+
+# One keep-alive session for all USDA calls: lookups reuse pooled TLS
+# connections instead of a new handshake each. The pool matches the
+# concurrency cap, so no connection is opened only to be discarded. Rate
+# limits and transient 5xx are retried with backoff; a final failure still
+# surfaces via raise_for_status.
+_retry = Retry(
+    total=3,
+    backoff_factor=0.3,
+    status_forcelist=[429, 500, 502, 503, 504],
+    raise_on_status=False,
+)
+_session = requests.Session()
+_session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=USDA_MAX_CONCURRENCY, max_retries=_retry))
+
+
+@functools.lru_cache(maxsize=512)
+def _macro_key(nutrient_name: str, unit_name):
+    """Which macro a USDA nutrient feeds (or None). The same few dozen
+    names recur in every response, so each is classified once."""
+    name = nutrient_name.lower()
+    if "energy" in name and unit_name == "KCAL":
+        return "calories"
+    elif name == "protein":
+        return "protein"
+    elif "carbohydrate" in name:
+        return "carbs"
+    elif "total lipid" in name or name == "fat":
+        return "fat"
+    return None
 
 
 def extract_macros(nutrients: list) -> dict:
@@ -13,21 +64,70 @@ def extract_macros(nutrients: list) -> dict:
     macros = {"calories": 0, "protein": 0, "carbs": 0, "fat": 0}
     
     for n in nutrients:
-        name = n.get("nutrientName", "").lower()
-        value = n.get("value", 0) or 0
-        
-        if "energy" in name and n.get("unitName") == "KCAL":
-            macros["calories"] = value
-        elif name == "protein":
-            macros["protein"] = value
-        elif "carbohydrate" in name:
-            macros["carbs"] = value
-        elif "total lipid" in name or name == "fat":
-            macros["fat"] = value
+        key = _macro_key(n.get("nutrientName", ""), n.get("unitName"))
+        if key is not None:
+            macros[key] = n.get("value", 0) or 0
     
     return macros
 
 
+def ingredient_macros(ingredient: dict) -> dict:
+    """
+    Per-100g macros for a stored ingredient record. Uses the ones computed at
+    lookup time (rawUSDA.macros_per_100g) when present instead of walking the
+    nutrient array again.
+    """
+    raw_usda = ingredient.get("rawUSDA")
+    if isinstance(raw_usda, dict) and raw_usda.get("macros_per_100g"):
+        return raw_usda["macros_per_100g"]
+    return extract_macros(ingredient.get("nutrition") or [])
+
+
+# Meat/protein foods that can have high protein
+MEAT_FOODS = (
+    "beef", "steak", "chicken", "turkey", "pork", "lamb", "duck",
+    "tuna", "salmon", "cod", "fish", "shrimp", "crab", "lobster",
+    "sardines", "anchovy", "mackerel", "herring",
+    "bacon", "sausage", "hot dog", "ribs", "meat", "burger", "patty",
+    "protein powder", "whey", "casein", "isolate", "concentrate"
+)
+
+# Very low protein foods (<5g per 100g expected)
+VERY_LOW_PROTEIN = ("broth", "soup", "stock", "tea", "coffee", "water", "juice", "matcha")
+
+PROTEIN_POWDERS = ("protein powder", "whey", "casein", "isolate", "concentrate")
+
+
+# Category bits for _keyword_mask
+MEAT = 1
+VERY_LOW = 2
+POWDER = 4
+
+_KEYWORD_BITS = {}
+for _bit, _words in ((MEAT, MEAT_FOODS), (VERY_LOW, VERY_LOW_PROTEIN), (POWDER, PROTEIN_POWDERS)):
+    for _word in _words:
+        _KEYWORD_BITS[_word] = _KEYWORD_BITS.get(_word, 0) | _bit
+# A keyword also carries the bits of every keyword inside it ("steak" holds
+# "tea"), so the longest match at each position stands in for all of them
+_KEYWORD_BITS = {
+    word: functools.reduce(int.__or__, (bits for other, bits in _KEYWORD_BITS.items() if other in word))
+    for word in _KEYWORD_BITS
+}
+# Lookahead so every start position is tried, overlapping like `in` does
+_KEYWORD_RE = re.compile(
+    "(?=(" + "|".join(re.escape(w) for w in sorted(_KEYWORD_BITS, key=len, reverse=True)) + "))"
+)
+
+
+@functools.lru_cache(maxsize=4096)
+def _keyword_mask(ingredient_lower: str) -> int:
+    """All keyword categories found in a name, in a single regex pass."""
+    mask = 0
+    for m in _KEYWORD_RE.finditer(ingredient_lower):
+        mask |= _KEYWORD_BITS[m.group(1)]
+    return mask
+
+
 def validate_usda_match(ingredient_name: str, matched_name: str, macros: dict) -> tuple[bool, str]:
     """
     Validate if USDA match seems reasonable.
@@ -36,42 +136,22 @@ def validate_usda_match(ingredient_name: str, matched_name: str, macros: dict) -
     ingredient_lower = ingredient_name.lower()
     matched_lower = matched_name.lower()
     
-    # Meat/protein foods that can have high protein
-    meat_foods = [
-        "beef", "steak", "chicken", "turkey", "pork", "lamb", "duck",
-        "tuna", "salmon", "cod", "fish", "shrimp", "crab", "lobster",
-        "sardines", "anchovy", "mackerel", "herring",
-        "bacon", "sausage", "hot dog", "ribs", "meat", "burger", "patty",
-        "protein powder", "whey", "casein", "isolate", "concentrate"
-    ]
-    
-    # Low protein foods that shouldn't have high protein
-    low_protein_foods = [
-        "broth", "soup", "stock", "tea", "coffee", "water", "juice",
-        "matcha", "green tea", "herbal", "spice", "seasoning",
-        "flour", "sugar", "oil", "butter", "cream", "milk",  # milk is ~3g/100g
-        "powder"  # most powders (matcha, cocoa, etc.) are low protein
-    ]
-    
-    # Very low protein foods (<5g per 100g expected)
-    very_low_protein = ["broth", "soup", "stock", "tea", "coffee", "water", "juice", "matcha"]
-    
     protein_per_100g = macros.get("protein", 0)
+    mask = _keyword_mask(ingredient_lower)
     
     # Check 1: Very strict for very low protein foods (broth, tea, etc.)
-    is_very_low_protein = any(food in ingredient_lower for food in very_low_protein)
+    is_very_low_protein = mask & VERY_LOW
     if is_very_low_protein and protein_per_100g > 10:
         return False, f"Suspicious: {ingredient_name} matched to {matched_name} with {protein_per_100g:.1f}g protein/100g (expected <10g for beverages/broth)"
     
     # Check 2: Non-meat foods shouldn't exceed 15g per 100g
-    is_meat = any(food in ingredient_lower for food in meat_foods)
-    is_low_protein_food = any(food in ingredient_lower for food in low_protein_foods)
+    is_meat = mask & MEAT
     
     if not is_meat and protein_per_100g > 15:
         return False, f"Suspicious: {ingredient_name} matched to {matched_name} with {protein_per_100g:.1f}g protein/100g (non-meat expected <15g)"
     
     # Check 3: Meat foods shouldn't exceed 40g per 100g (unless it's pure protein powder)
-    is_protein_powder = any(p in ingredient_lower for p in ["protein powder", "whey", "casein", "isolate", "concentrate"])
+    is_protein_powder = mask & POWDER
     if is_meat and not is_protein_powder and protein_per_100g > 40:
         return False, f"Suspicious: {ingredient_name} matched to {matched_name} with {protein_per_100g:.1f}g protein/100g (meat expected <40g)"
     
@@ -88,13 +168,60 @@ def usda_lookup(ingredient_name):
     """
     Look up nutrition data from USDA FoodData Central.
     Returns macros per 100g serving, or None if match seems invalid.
+
+    Results are cached in-process and on disk (see usda_cache), keyed by the
+    normalized name. Treat the returned dict as read-only.
     """
+    return _cached_lookup(usda_cache.normalize_name(ingredient_name))
+
+
+def usda_lookup_many(ingredient_names, max_workers=8):
+    """
+    Look up several ingredients concurrently, preserving order.
+    A lookup that raises comes back as the exception instead of a result,
+    so one bad ingredient doesn't sink the rest of the meal.
+    """
+    def _safe_lookup(name):
+        try:
+            return usda_lookup(name)
+        except Exception as e:
+            return e
+
+    # Text and image parses of the same meal often both list "cheese" etc.;
+    # look each name up once so two threads don't race the same cache miss
+    keys = [usda_cache.normalize_name(name) for name in ingredient_names]
+    unique = list(dict.fromkeys(keys))
+
+    if len(unique) <= 1:
+        results = {key: _safe_lookup(key) for key in unique}
+    else:
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            results = dict(zip(unique, pool.map(_safe_lookup, unique)))
+    return [results[key] for key in keys]
+
+
+@functools.lru_cache(maxsize=4096)
+def _cached_lookup(key):
+    hit, result = usda_cache.get(key)
+    if hit:
+        return result
+    result = _usda_fetch(key)
+    usda_cache.put(key, result)
+    return result
+
+
+def _usda_fetch(ingredient_name):
+    """Query USDA and validate the top match (no caching)."""
+    if not USDA_KEY:
+        # Fail fast instead of spending a round trip on a guaranteed 403
+        raise RuntimeError("USDA_KEY is not set")
     params = {
         "query": ingredient_name,
         "api_key": USDA_KEY,
         "pageSize": 1
     }
-    r = requests.get(USDA_URL, params=params)
+    with _usda_slots:
+        r = _session.get(USDA_URL, params=params, timeout=USDA_TIMEOUT_S)
     r.raise_for_status()
     data = r.json()
     
@@ -107,7 +234,7 @@ def usda_lookup(ingredient_name):
         # Validate the match
         is_valid, reason = validate_usda_match(ingredient_name, matched_name, macros)
         if not is_valid:
-            print(f"⚠️  Rejected USDA match: {reason}")
+            log.info("⚠️  Rejected USDA match: %s", reason)
             return None
         
         return {
@@ -0,0 +1,54 @@
+"""
+Persistent cache for GPT ingredient parses of meal text.
+
+People log the same wording day after day ("coffee with oat milk", "2 eggs
+and toast"), so successful parses are stored in a small SQLite file keyed
+by parser_gpt's normalized-text hash. Repeat entries skip the GPT call
+across runs, not just within one.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+CACHE_PATH = Path(os.getenv("PARSE_CACHE_PATH") or Path(__file__).parent / ".parse_cache.sqlite")
+MAX_AGE_DAYS = 90
+
+_conn = None
+_lock = threading.Lock()
+
+
+def _connection():
+    global _conn
+    if _conn is None:
+        _conn = sqlite3.connect(CACHE_PATH, check_same_thread=False)
+        _conn.execute("PRAGMA journal_mode=WAL")
+        _conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, payload TEXT, ts INTEGER)"
+        )
+    return _conn
+
+
+def get(key: str):
+    """Cached ingredient list for a text key, or None."""
+    cutoff = int(time.time()) - MAX_AGE_DAYS * 86400
+    with _lock:
+        row = _connection().execute(
+            "SELECT payload FROM cache WHERE key = ? AND ts >= ?", (key, cutoff)
+        ).fetchone()
+    return json.loads(row[0]) if row else None
+
+
+def put(key: str, items: list):
+    """Store a successful parse."""
+    payload = json.dumps(items)
+    with _lock:
+        conn = _connection()
+        conn.execute(
+            "INSERT OR REPLACE INTO cache (key, payload, ts) VALUES (?, ?, ?)",
+            (key, payload, int(time.time())),
+        )
+        conn.commit()
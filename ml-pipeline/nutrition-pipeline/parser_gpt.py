@@ -1,14 +1,85 @@
+import io
 import os
+import re
 import json
+import time
+import hashlib
+import threading
 from openai import OpenAI
 
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+import parse_cache
 
-def parse_ingredients(text: str):
-    prompt = f"""
-    Extract foods, drinks, supplements from: "{text}".
-    
-    IMPORTANT: Decompose complex/composite foods into their base ingredients.
+# The SDK retries 429/5xx with exponential backoff; allow more attempts since
+# enrich_meals now issues calls from several threads at once
+client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=5)
+
+# Cap concurrent GPT requests regardless of how many callers are running
+GPT_MAX_CONCURRENCY = 8
+_gpt_slots = threading.Semaphore(GPT_MAX_CONCURRENCY)
+
+# A decomposed meal is ~10 items of ~40 tokens; the cap only stops runaway
+# output. temperature=0 keeps parses repeatable, which the caches rely on.
+PARSE_MAX_TOKENS_PER_MEAL = 800
+
+# Longest parse_ingredients_offline waits on a Batch API job (its completion
+# window) before giving the texts back to the per-meal path
+BATCH_MAX_WAIT_S = 24 * 3600
+# How long a cancelled batch gets to finish cancelling and publish the
+# output of the requests it did complete
+BATCH_CANCEL_WAIT_S = 10 * 60
+
+# Parsed text results keyed by a hash of the normalized text, so meals logged
+# with the same wording ("coffee with oat milk") only hit GPT once per run
+# (and, through parse_cache on disk, once across runs)
+_text_parse_cache = {}
+
+
+# Single-item entries common enough to skip GPT entirely:
+# name -> (quantity, unit, category), using the portions the prompt asks for
+_SIMPLE_ENTRIES = {
+    "coffee": (8, "oz", "drink"),
+    "black coffee": (8, "oz", "drink"),
+    "espresso": (1, "oz", "drink"),
+    "tea": (8, "oz", "drink"),
+    "green tea": (8, "oz", "drink"),
+    "water": (8, "oz", "drink"),
+    "apple": (1, "piece", "food"),
+    "banana": (1, "piece", "food"),
+    "orange": (1, "piece", "food"),
+    "fish oil": (1, "capsule", "supplement"),
+    "vitamin d": (1, "pill", "supplement"),
+    "magnesium": (1, "pill", "supplement"),
+    "melatonin": (1, "pill", "supplement"),
+}
+
+# "coffee", "2 apples", "12 oz coffee", "2 capsules fish oil"
+_SIMPLE_ENTRY_RE = re.compile(
+    r"^(?:(\d+(?:\.\d+)?)\s*(oz|cups?|pills?|capsules?)?\s+)?("
+    + "|".join(sorted(map(re.escape, _SIMPLE_ENTRIES), key=len, reverse=True))
+    + r")s?$"
+)
+
+
+def _quick_parse(text: str):
+    """Parse a trivially simple entry without GPT; None if it needs GPT."""
+    m = _SIMPLE_ENTRY_RE.match(" ".join(text.lower().split()))
+    if not m:
+        return None
+    count, unit, name = m.groups()
+    quantity, default_unit, category = _SIMPLE_ENTRIES[name]
+    if count and unit:
+        quantity = float(count)
+    elif count:
+        quantity = float(count) * quantity
+    unit = unit or default_unit
+    # Keep units singular like GPT's ("cup", "pill"), except oz
+    if unit != "oz":
+        unit = unit.rstrip("s")
+    return [{"name": name, "quantity": quantity, "unit": unit, "category": category}]
+
+
+# Prompt sections shared by the single, batched and Batch API text parsers
+_DECOMPOSE_RULES = """    IMPORTANT: Decompose complex/composite foods into their base ingredients.
     Examples:
     - "burrito" → tortilla, rice, beans, cheese, salsa, sour cream
     - "omelette" → eggs, butter, cheese, [any fillings mentioned]
@@ -20,8 +91,9 @@ def parse_ingredients(text: str):
     DO NOT return composite foods like "burrito" or "sandwich" - break them down!
     Simple items stay as-is: "apple", "coffee", "eggs", "chicken breast"
     
-    Return ONLY a JSON array (no markdown, no explanation).
-    Each item must have:
+"""
+
+_ITEM_FIELDS = """    Each item must have:
     - name (string) - specific ingredient name
     - quantity (float) - estimate realistic portions
     - unit (string) - use appropriate units:
@@ -36,13 +108,77 @@ def parse_ingredients(text: str):
         * Supplements: count (unit: "pill" or "capsule")
     - category (string) - "food", "drink", "supplement", or "other"
     
+"""
+
+# Every text prompt starts with this byte-identical block and puts the meal
+# text(s) last, so requests share the longest possible prefix for OpenAI's
+# automatic prompt caching
+_PARSE_PREAMBLE = f"""
+    Extract foods, drinks, supplements from the meal text at the end.
+    
+{_DECOMPOSE_RULES}{_ITEM_FIELDS}"""
+
+
+def _text_key(text: str) -> str:
+    normalized = " ".join(text.lower().split())
+    return hashlib.sha1(normalized.encode("utf-8")).hexdigest()[:16]
+
+
+def _cached_parse(key: str):
+    """Cached ingredient list for a text key (memory, then disk), or None."""
+    cached = _text_parse_cache.get(key)
+    if cached is None:
+        cached = parse_cache.get(key)
+        if cached is not None:
+            _text_parse_cache[key] = cached
+    return cached
+
+
+def _usable_items(parsed) -> list:
+    """The named ingredient dicts in a GPT parse ([] if it isn't a list)."""
+    if not isinstance(parsed, list):
+        return []
+    return [item for item in parsed if isinstance(item, dict) and isinstance(item.get("name"), str)]
+
+
+def _store_parse(key: str, parsed) -> bool:
+    """
+    Remember a GPT parse in memory and on disk. Only well-formed parses (a
+    list of named ingredient dicts) are cached; returns whether it was.
+    """
+    items = _usable_items(parsed)
+    if not isinstance(parsed, list) or len(items) != len(parsed):
+        return False
+    _text_parse_cache[key] = [dict(item) for item in items]
+    parse_cache.put(key, items)
+    return True
+
+
+def parse_ingredients(text: str):
+    key = _text_key(text)
+    cached = _cached_parse(key)
+    if cached is not None:
+        # Callers mutate the returned dicts, so hand out copies
+        return [dict(item) for item in cached]
+
+    quick = _quick_parse(text)
+    if quick is not None:
+        _text_parse_cache[key] = quick
+        return [dict(item) for item in quick]
+
+    prompt = f"""{_PARSE_PREAMBLE}    Return ONLY a JSON array (no markdown, no explanation).
     Return empty array [] if no food/drinks/supplements found.
+
+    Meal: "{text}"
     """
 
-    resp = client.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=[{"role": "user", "content": prompt}]
-    )
+    with _gpt_slots:
+        resp = client.chat.completions.create(
+            model="gpt-4o-mini",
+            messages=[{"role": "user", "content": prompt}],
+            temperature=0,
+            max_tokens=PARSE_MAX_TOKENS_PER_MEAL,
+        )
 
     raw = resp.choices[0].message.content.strip()
 
@@ -54,18 +190,244 @@ def parse_ingredients(text: str):
         raw = raw.strip()
 
     try:
-        return json.loads(raw)
+        parsed = json.loads(raw)
     except Exception as e:
         print("Parser error:", e, "RAW:", raw)
         return []
 
+    if not _store_parse(key, parsed):
+        # e.g. {"ingredients": [...]} or bare strings: keep what's usable,
+        # but don't cache a malformed answer
+        print("Parser error: unexpected shape, RAW:", raw)
+    return _usable_items(parsed)
+
+
+def parse_ingredients_batch(texts, batch_size=20):
+    """
+    Parse several meal texts with one GPT call per `batch_size` texts.
+
+    The instructions are sent once per batch instead of once per meal, which
+    saves prompt tokens and round-trips. Each result must echo its meal's
+    number and be a well-formed item list before it is cached (in the same
+    cache as parse_ingredients); anything else is skipped, leaving that text
+    for parse_ingredients to handle. Repeated texts are only sent once.
+    Returns ingredient lists in input order (None for texts left unparsed).
+    """
+    keys = [_text_key(text) for text in texts]
+
+    # Each distinct uncached text is sent once, however often it was logged
+    pending = {}
+    for key, text in zip(keys, texts):
+        if _cached_parse(key) is not None:
+            continue
+        quick = _quick_parse(text)
+        if quick is not None:
+            _text_parse_cache[key] = quick
+        else:
+            pending.setdefault(key, text)
+    pending = list(pending.items())
+
+    for start in range(0, len(pending), batch_size):
+        chunk = pending[start:start + batch_size]
+        numbered = "\n".join(f'{n}. "{text}"' for n, (_, text) in enumerate(chunk, 1))
+        prompt = f"""{_PARSE_PREAMBLE}    There are several meals, numbered. Return ONLY a JSON object
+    {{"results": [{{"meal": 1, "items": [...]}}, {{"meal": 2, "items": [...]}}, ...]}}
+    with one entry per meal, "meal" being its number from the list.
+    Use "items": [] for a meal with no food/drinks/supplements.
+
+    Meals ({len(chunk)}):
+{numbered}
+    """
+
+        try:
+            with _gpt_slots:
+                resp = client.chat.completions.create(
+                    model="gpt-4o-mini",
+                    messages=[{"role": "user", "content": prompt}],
+                    response_format={"type": "json_object"},
+                    temperature=0,
+                    max_tokens=PARSE_MAX_TOKENS_PER_MEAL * len(chunk),
+                )
+            results = json.loads(resp.choices[0].message.content)["results"]
+        except Exception as e:
+            # Texts stay uncached; parse_ingredients picks them up per meal
+            print("Batch parser error:", e)
+            continue
+
+        if not isinstance(results, list):
+            print("Batch parser error: results is not a list")
+            continue
+        for result in results:
+            # Match by the echoed number, never by position
+            n = result.get("meal") if isinstance(result, dict) else None
+            if not isinstance(n, int) or not 1 <= n <= len(chunk):
+                continue
+            key, _ = chunk[n - 1]
+            if key not in _text_parse_cache:
+                _store_parse(key, result.get("items"))
+
+    # Callers mutate the returned dicts, so hand out copies
+    results = []
+    for key in keys:
+        cached = _text_parse_cache.get(key)
+        results.append([dict(item) for item in cached] if cached is not None else None)
+    return results
+
+
+def parse_ingredients_offline(texts, poll_interval=30, max_wait=BATCH_MAX_WAIT_S):
+    """
+    Parse meal texts through the OpenAI Batch API.
+
+    For big backfills where nobody is waiting on the result: batch requests
+    cost half as much and don't count against the synchronous rate limits,
+    but may take up to 24h. Blocks until the batch finishes (or `max_wait`
+    seconds pass, after which it's cancelled and its finished requests are
+    kept), fills the text parse cache and returns ingredient lists in input
+    order (None for texts whose request failed or didn't finish, so the
+    caller can retry them synchronously).
+    """
+    unique = {}
+    for text in texts:
+        unique.setdefault(_text_key(text), text)
+
+    lines = []
+    for key, text in unique.items():
+        if _cached_parse(key) is not None:
+            continue
+        quick = _quick_parse(text)
+        if quick is not None:
+            _text_parse_cache[key] = quick
+            continue
+        prompt = f"""{_PARSE_PREAMBLE}    Return ONLY a JSON object {{"results": [...]}} with the items array.
+    Use an empty array [] if no food/drinks/supplements found.
+
+    Meal: "{text}"
+    """
+        lines.append(json.dumps({
+            "custom_id": key,
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {
+                "model": "gpt-4o-mini",
+                "messages": [{"role": "user", "content": prompt}],
+                "response_format": {"type": "json_object"},
+                "temperature": 0,
+                "max_tokens": PARSE_MAX_TOKENS_PER_MEAL,
+            },
+        }))
+
+    if lines:
+        upload = client.files.create(
+            file=("parse_batch.jsonl", io.BytesIO("\n".join(lines).encode("utf-8"))),
+            purpose="batch",
+        )
+        batch = client.batches.create(
+            input_file_id=upload.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h",
+        )
+        print(f"📨 Submitted batch {batch.id} ({len(lines)} texts)")
+
+        done = ("completed", "failed", "expired", "cancelled")
+        deadline = time.monotonic() + max_wait
+        cancelling = False
+        while batch.status not in done:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                if cancelling:
+                    break  # still cancelling: skip whatever it hasn't written yet
+                print(f"⏰ Batch {batch.id} still {batch.status} after {max_wait}s, cancelling")
+                try:
+                    client.batches.cancel(batch.id)
+                except Exception as e:
+                    print("Batch cancel error:", e)
+                    break
+                # A cancelled batch still publishes the requests it finished;
+                # wait (briefly) for that output instead of re-parsing them
+                cancelling = True
+                deadline = time.monotonic() + BATCH_CANCEL_WAIT_S
+                remaining = BATCH_CANCEL_WAIT_S
+            time.sleep(min(poll_interval, remaining))
+            batch = client.batches.retrieve(batch.id)
+        print(f"📬 Batch {batch.id} {batch.status}")
+
+        if batch.output_file_id:
+            for line in client.files.content(batch.output_file_id).text.splitlines():
+                try:
+                    row = json.loads(line)
+                    content = row["response"]["body"]["choices"][0]["message"]["content"]
+                    parsed = json.loads(content)["results"]
+                except Exception as e:
+                    print("Batch parser error:", e)
+                    continue
+                _store_parse(row["custom_id"], parsed)
+
+    results = []
+    for text in texts:
+        cached = _text_parse_cache.get(_text_key(text))
+        results.append([dict(item) for item in cached] if cached is not None else None)
+    return results
+
 import base64
 import requests
 
+# Reused across image downloads so each one doesn't open a new TCP/TLS connection
+_http = requests.Session()
+
+# Publicly reachable PocketBase base URL (e.g. https://pb.example.com). Only
+# when it's set are images handed to OpenAI by URL; a file token minted for
+# an internal host would otherwise be sent to OpenAI for nothing.
+PB_PUBLIC_URL = (os.getenv("PB_PUBLIC_URL") or "").rstrip("/")
+
+
+def _remote_image_url(file_path: str, pb_url: str, token: str | None):
+    """
+    URL OpenAI can fetch the image from directly, or None when no
+    PB_PUBLIC_URL is configured. Protected files get a short-lived
+    PocketBase file token appended.
+    """
+    if not PB_PUBLIC_URL:
+        return None
+
+    image_url = f"{PB_PUBLIC_URL}{file_path}"
+    if not token:
+        return image_url
+    try:
+        r = _http.post(f"{pb_url}/api/files/token", headers={"Authorization": f"Bearer {token}"})
+        r.raise_for_status()
+        return f"{image_url}?token={r.json()['token']}"
+    except Exception:
+        return None
+
+
+def _vision_parse(prompt: str, image_ref: str) -> str:
+    """One GPT-4o-mini Vision call; image_ref is an https or data: URL."""
+    with _gpt_slots:
+        resp = client.chat.completions.create(
+            model="gpt-4o-mini",
+            messages=[
+                {
+                    "role": "user",
+                    "content": [
+                        {"type": "text", "text": prompt},
+                        {"type": "image_url", "image_url": {"url": image_ref}},
+                    ],
+                }
+            ],
+            temperature=0,
+            max_tokens=PARSE_MAX_TOKENS_PER_MEAL,
+        )
+    return resp.choices[0].message.content.strip()
+
+
 def parse_ingredients_from_image(meal: dict, pb_url: str, token: str | None = None):
     """
-    Parses ingredients from a PocketBase image record by downloading the file locally
-    and sending it to GPT-4o-mini Vision as base64.
+    Parses ingredients from a PocketBase image record with GPT-4o-mini Vision.
+
+    When PB_PUBLIC_URL is set, OpenAI is handed the public file URL and
+    fetches the image itself (a ~100 byte request instead of the whole image
+    as base64). Otherwise, or if OpenAI can't fetch it, the image is
+    downloaded locally and sent as base64.
     """
     raw = ""
     try:
@@ -74,16 +436,8 @@ def parse_ingredients_from_image(meal: dict, pb_url: str, token: str | None = No
             return []
 
         meal_id = meal["id"]
-        image_url = f"{pb_url}/api/files/meals/{meal_id}/{image_field}"
-
-        # Download image data
-        headers = {"Authorization": f"Bearer {token}"} if token else {}
-        resp = requests.get(image_url, headers=headers)
-        resp.raise_for_status()
-        image_bytes = resp.content
-
-        # Encode to base64 for GPT
-        image_b64 = base64.b64encode(image_bytes).decode("utf-8")
+        file_path = f"/api/files/meals/{meal_id}/{image_field}"
+        image_url = f"{pb_url}{file_path}"
 
         prompt = """
         Look at this image and identify ONLY edible items: foods, drinks, or supplements.
@@ -117,23 +471,23 @@ def parse_ingredients_from_image(meal: dict, pb_url: str, token: str | None = No
         If no edible items are visible, return an empty array [].
         """
 
-        resp = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": prompt},
-                        {
-                            "type": "image_url",
-                            "image_url": {"url": f"data:image/jpeg;base64,{image_b64}"},
-                        },
-                    ],
-                }
-            ],
-        )
+        raw = None
+        remote_url = _remote_image_url(file_path, pb_url, token)
+        if remote_url:
+            try:
+                raw = _vision_parse(prompt, remote_url)
+            except Exception as e:
+                print("Image URL not usable by OpenAI, sending base64:", e)
+
+        if raw is None:
+            # Download image data
+            headers = {"Authorization": f"Bearer {token}"} if token else {}
+            resp = _http.get(image_url, headers=headers)
+            resp.raise_for_status()
 
-        raw = resp.choices[0].message.content.strip()
+            # Encode to base64 for GPT
+            image_b64 = base64.b64encode(resp.content).decode("utf-8")
+            raw = _vision_parse(prompt, f"data:image/jpeg;base64,{image_b64}")
 
         if raw.startswith("```"):
             raw = raw.strip("`")
@@ -1,4 +1,6 @@
-import os, requests
+import os, json, time, base64, requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from dotenv import load_dotenv
 load_dotenv()
 
@@ -7,61 +9,210 @@ PB_URL = os.getenv("PB_URL") or "http://127.0.0.1:8090"
 PB_EMAIL= os.getenv("PB_EMAIL")      # service user email
 PB_PASSWORD = os.getenv("PB_PASSWORD")      # service user password
 
-# Keep token cached in memory
+# Keep token cached in memory until shortly before its JWT `exp`
 _cached_token = None
+_token_expires_at = 0
+TOKEN_REFRESH_MARGIN_S = 60
+
+# Shared keep-alive session so repeated PocketBase calls reuse pooled connections.
+# Idempotent requests (GET/DELETE) are retried on 429/5xx; urllib3 never
+# replays POST/PATCH, so creates and updates can't be duplicated.
+_retry = Retry(
+    total=3,
+    backoff_factor=0.3,
+    status_forcelist=[429, 500, 502, 503, 504],
+    raise_on_status=False,
+)
+_session = requests.Session()
+_session.mount("http://", HTTPAdapter(pool_maxsize=32, max_retries=_retry))
+_session.mount("https://", HTTPAdapter(pool_maxsize=32, max_retries=_retry))
+
+
+# PocketBase's default cap on sub-requests per /api/batch call
+BATCH_MAX_REQUESTS = 50
+
+# Cleared after the first 403/404 from /api/batch (see _post_batch)
+_batch_supported = True
+
+
+def _jwt_expiry(token):
+    """Read the `exp` claim from a JWT without verifying it (inf if unreadable)."""
+    try:
+        payload = token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        return float(json.loads(base64.urlsafe_b64decode(payload))["exp"])
+    except (IndexError, KeyError, TypeError, ValueError):
+        return float("inf")
+
 
 def get_token():
-    global _cached_token
-    if _cached_token:
+    global _cached_token, _token_expires_at
+    if _cached_token and time.time() < _token_expires_at - TOKEN_REFRESH_MARGIN_S:
         return _cached_token
     
-    # Log in service user
+    # Log in service user (without sending the stale token)
     url = f"{PB_URL}/api/collections/users/auth-with-password"
-    r = requests.post(url, json={"identity":PB_EMAIL, "password": PB_PASSWORD})
+    r = _session.post(url, json={"identity":PB_EMAIL, "password": PB_PASSWORD},
+                      headers={"Authorization": None})
     r.raise_for_status()
     data = r.json()
     _cached_token = data["token"]
+    _token_expires_at = _jwt_expiry(_cached_token)
     return _cached_token
 
-def fetch_meals():
-    headers = {"Authorization": f"Bearer {get_token()}"}
-    all_items = []
+
+def session():
+    """Shared PocketBase session with the current auth header set."""
+    _session.headers["Authorization"] = f"Bearer {get_token()}"
+    return _session
+
+
+def _request(method, url, **kwargs):
+    """Authenticated request; logs in again once if the token was rejected."""
+    global _cached_token
+    if "json" in kwargs:
+        # Compact separators: nutrition/rawUSDA payloads are large nested
+        # lists and requests' default encoder pads every ", " and ": "
+        kwargs["data"] = json.dumps(kwargs.pop("json"), separators=(",", ":"))
+        kwargs["headers"] = {**kwargs.get("headers", {}), "Content-Type": "application/json"}
+    r = session().request(method, url, **kwargs)
+    if r.status_code == 401:
+        _cached_token = None
+        r = session().request(method, url, **kwargs)
+    return r
+
+def iter_meals(fields=None, filter=None):
+    """
+    Yield meals newest first, one page at a time.
+
+    Pages are fetched by cursor (created, id) rather than page number, so a
+    caller that writes while iterating (e.g. enrich_meals parsing meals out
+    of an "unparsed" filter) can't shift later pages and skip meals.
+
+    Args:
+        fields: Optional comma-separated field projection (e.g. "id,text") to
+            skip columns the caller doesn't read
+        filter: Optional PocketBase filter expression, applied server-side
+    """
     page = 1
-    per_page = 200  # grab up to 200 at a time
+    per_page = 500  # chosen batch size (not the server's page-size limit)
+    url = f"{PB_URL}/api/collections/meals/records"
+    if fields:
+        # The cursor needs these on every item
+        fields = ",".join(dict.fromkeys(fields.split(",") + ["id", "created"]))
+    cursor = None
 
     while True:
-        url = f"{PB_URL}/api/collections/meals/records?page={page}&perPage={per_page}&sort=-created"
+        expr = filter
+        if cursor:
+            created, meal_id = cursor
+            after = f"(created < '{created}' || (created = '{created}' && id < '{meal_id}'))"
+            expr = f"({filter}) && {after}" if filter else after
+        params = {"perPage": per_page, "sort": "-created,-id", "skipTotal": 1}
+        if fields:
+            params["fields"] = fields
+        if expr:
+            params["filter"] = expr
         print(f"🔄 Fetching meals page {page}...")
-        r = requests.get(url, headers=headers)
+        r = _request("GET", url, params=params)
         r.raise_for_status()
         data = r.json()
         items = data.get("items", [])
-        all_items.extend(items)
+        yield from items
         if len(items) < per_page:
             break
+        cursor = (items[-1]["created"], items[-1]["id"])
         page += 1
 
+
+def fetch_meals(fields=None):
+    """Fetch all meals, newest first (see iter_meals)."""
+    all_items = list(iter_meals(fields=fields))
     print(f"✅ Retrieved {len(all_items)} meals from PocketBase")
     return all_items
 
 
 def insert_ingredient(ingredient):
     url = f"{PB_URL}/api/collections/ingredients/records"
-    headers = {"Authorization": f"Bearer {get_token()}"}
-    r = requests.post(url, headers=headers, json=ingredient)
+    r = _request("POST", url, json=ingredient)
     r.raise_for_status()
     return r.json()
 
-def fetch_records(collection_name, per_page=200):
-    """Generic fetch helper for any PocketBase collection."""
-    headers = {"Authorization": f"Bearer {get_token()}"}
+def update_record(collection_name, record_id, fields):
+    """PATCH selected fields on one record. Returns the response."""
+    url = f"{PB_URL}/api/collections/{collection_name}/records/{record_id}"
+    return _request("PATCH", url, json=fields)
+
+
+def _post_batch(batch_requests):
+    """
+    Send one transactional /api/batch request. Returns the response, or None
+    when the server doesn't accept batch requests (disabled - the PocketBase
+    default - or a pre-0.23 server). That answer is remembered, so later
+    calls go straight to their per-record fallback.
+    """
+    global _batch_supported
+    if not _batch_supported:
+        return None
+    r = _request("POST", f"{PB_URL}/api/batch", json={"requests": batch_requests})
+    if r.status_code in (403, 404):
+        _batch_supported = False
+        return None
+    return r
+
+
+def insert_ingredients_bulk(ingredients, chunk_size=BATCH_MAX_REQUESTS):
+    """
+    Insert several ingredients via PocketBase's batch API, one transactional
+    request per chunk (at most BATCH_MAX_REQUESTS, the server's default limit).
+
+    A chunk the server rejects wrote nothing, so it's retried one POST per
+    ingredient; batch-disabled servers always take that path. Rows that fail
+    there are reported, not raised, because the rows before them are stored.
+
+    Returns (created, failed): the created records in order, and
+    (ingredient, error) pairs for rows that couldn't be inserted.
+    """
+    chunk_size = min(chunk_size, BATCH_MAX_REQUESTS)
+    created = []
+    failed = []
+
+    for start in range(0, len(ingredients), chunk_size):
+        chunk = ingredients[start:start + chunk_size]
+        r = _post_batch([
+            {"method": "POST", "url": "/api/collections/ingredients/records", "body": ing}
+            for ing in chunk
+        ])
+        if r is not None and r.ok:
+            created.extend(res.get("body", {}) for res in r.json())
+            continue
+        for ing in chunk:
+            try:
+                created.append(insert_ingredient(ing))
+            except requests.RequestException as e:
+                failed.append((ing, e))
+
+    return created, failed
+
+
+def fetch_records(collection_name, per_page=200, fields=None):
+    """
+    Generic fetch helper for any PocketBase collection.
+
+    Args:
+        fields: Optional comma-separated field projection, so PocketBase
+            doesn't serialize (and we don't decode) columns the caller ignores
+    """
     all_items = []
     page = 1
+    url = f"{PB_URL}/api/collections/{collection_name}/records"
 
     while True:
-        url = f"{PB_URL}/api/collections/{collection_name}/records?page={page}&perPage={per_page}&sort=-created"
+        params = {"page": page, "perPage": per_page, "sort": "-created"}
+        if fields:
+            params["fields"] = fields
         print(f"📡 Fetching {collection_name} page {page}...")
-        r = requests.get(url, headers=headers)
+        r = _request("GET", url, params=params)
         r.raise_for_status()
         data = r.json()
         items = data.get("items", [])
@@ -76,7 +227,6 @@ def fetch_records(collection_name, per_page=200):
 
 def get_parsed_meal_ids():
     """Get set of meal IDs that already have ingredients parsed."""
-    headers = {"Authorization": f"Bearer {get_token()}"}
     meal_ids = set()
     page = 1
     per_page = 500
@@ -84,7 +234,7 @@ def get_parsed_meal_ids():
     while True:
         # Only fetch the mealId field to minimize data transfer
         url = f"{PB_URL}/api/collections/ingredients/records?page={page}&perPage={per_page}&fields=mealId"
-        r = requests.get(url, headers=headers)
+        r = _request("GET", url)
         r.raise_for_status()
         data = r.json()
         items = data.get("items", [])
@@ -100,42 +250,126 @@ def get_parsed_meal_ids():
 
 def fetch_unparsed_meals(since_date=None):
     """
-    Fetch only meals that haven't been parsed yet.
+    Yield only meals that haven't been parsed yet, page by page, so callers
+    can start processing before every meal has been fetched.
     
     Args:
         since_date: Optional ISO date string (e.g. '2026-01-24') to filter meals after this date
     """
-    all_meals = fetch_meals()
-    parsed_ids = get_parsed_meal_ids()
-    
-    # Filter by date if specified
+    # Let PocketBase drop older meals instead of downloading and discarding them
+    date_filter = None
     if since_date:
-        from datetime import datetime
-        cutoff = datetime.fromisoformat(since_date)
-        all_meals = [m for m in all_meals if m.get("timestamp") and 
-                     datetime.fromisoformat(m["timestamp"].replace("Z", "+00:00").split("+")[0]) >= cutoff]
-        print(f"📅 Filtered to {len(all_meals)} meals since {since_date}")
-    
-    unparsed = [m for m in all_meals if m["id"] not in parsed_ids]
-    print(f"🆕 {len(unparsed)} unparsed meals (skipped {len(parsed_ids)} already parsed)")
-    return unparsed
+        # PocketBase stores datetimes as "YYYY-MM-DD HH:MM:SS.sssZ"
+        date_filter = f"timestamp >= '{since_date.replace('T', ' ')}'"
+        print(f"📅 Only meals since {since_date}")
+
+    # Only what enrich_meals reads (image is just the filename)
+    fields = "id,text,image,timestamp"
+
+    # Meals no ingredient points at (back-relation on ingredients.mealId), so
+    # already-parsed meals never leave the server
+    unparsed_filter = "ingredients_via_mealId:length = 0"
+    probe = _request("GET", f"{PB_URL}/api/collections/meals/records",
+                     params={"perPage": 1, "fields": "id", "skipTotal": 1, "filter": unparsed_filter})
+    if probe.ok:
+        if date_filter:
+            unparsed_filter = f"{unparsed_filter} && {date_filter}"
+        yield from iter_meals(fields=fields, filter=unparsed_filter)
+        return
+
+    # Server can't filter on the back-relation: diff against every parsed mealId
+    parsed_ids = get_parsed_meal_ids()
+    print(f"⏭️  Skipping {len(parsed_ids)} already parsed meals")
+    for meal in iter_meals(fields=fields, filter=date_filter):
+        if meal["id"] not in parsed_ids:
+            yield meal
+
+
+def normalize_nutrition(ingredient):
+    """
+    Coerce an ingredient's `nutrition` field to a list in place.
+
+    Older records stored the USDA nutrient array as a JSON string; parsing it
+    here means downstream loops can assume a list.
+    """
+    nutrition = ingredient.get("nutrition")
+    if isinstance(nutrition, str):
+        try:
+            nutrition = json.loads(nutrition)
+        except ValueError:
+            nutrition = []
+    if not isinstance(nutrition, list):
+        nutrition = []
+    ingredient["nutrition"] = nutrition
+    return ingredient
+
+
+def fetch_ingredients_for_meals(meal_ids, chunk_size=50, per_page=500):
+    """
+    Fetch ingredients for many meals at once: one filtered query per chunk of
+    `chunk_size` ids (keeps the URL short) instead of one request per meal.
+    Returns {meal_id: [ingredients]} with nutrition normalized to a list.
+    """
+    by_meal = {meal_id: [] for meal_id in meal_ids}
+    ids = list(by_meal)
+    url = f"{PB_URL}/api/collections/ingredients/records"
+
+    for start in range(0, len(ids), chunk_size):
+        chunk = ids[start:start + chunk_size]
+        filter_expr = " || ".join(f'mealId="{meal_id}"' for meal_id in chunk)
+        page = 1
+        while True:
+            r = _request("GET", url, params={"page": page, "perPage": per_page, "filter": filter_expr})
+            r.raise_for_status()
+            items = r.json().get("items", [])
+            for item in items:
+                by_meal.setdefault(item.get("mealId"), []).append(normalize_nutrition(item))
+            if len(items) < per_page:
+                break
+            page += 1
+
+    return by_meal
 
 
 def fetch_all_ingredients():
-    """Fetch all ingredients from PocketBase."""
-    return fetch_records("ingredients")
+    """Fetch all ingredients from PocketBase (nutrition normalized to a list)."""
+    return [normalize_nutrition(ing) for ing in fetch_records("ingredients")]
+
+
+def delete_records_bulk(collection_name, record_ids, chunk_size=BATCH_MAX_REQUESTS):
+    """
+    Delete records via PocketBase's batch API, one request per chunk.
+    A batch is a single transaction, so if any delete in a chunk fails
+    (e.g. already gone) nothing was deleted and that chunk is retried one
+    record at a time, as is every chunk when batch requests are disabled.
+    Returns (deleted, failed): the count deleted, and (record_id, status_code)
+    pairs for records that couldn't be.
+    """
+    chunk_size = min(chunk_size, BATCH_MAX_REQUESTS)
+    deleted = 0
+    failed = []
+
+    for start in range(0, len(record_ids), chunk_size):
+        chunk = record_ids[start:start + chunk_size]
+        r = _post_batch([
+            {"method": "DELETE", "url": f"/api/collections/{collection_name}/records/{record_id}"}
+            for record_id in chunk
+        ])
+        if r is not None and r.ok:
+            deleted += len(chunk)
+            continue
+        for record_id in chunk:
+            r = _request("DELETE", f"{PB_URL}/api/collections/{collection_name}/records/{record_id}")
+            if r.status_code == 204:
+                deleted += 1
+            else:
+                failed.append((record_id, r.status_code))
+
+    return deleted, failed
 
 
 def delete_all_ingredients():
     """Delete all ingredients from PocketBase. Returns count deleted."""
-    headers = {"Authorization": f"Bearer {get_token()}"}
     ingredients = fetch_all_ingredients()
-    
-    deleted = 0
-    for ing in ingredients:
-        url = f"{PB_URL}/api/collections/ingredients/records/{ing['id']}"
-        r = requests.delete(url, headers=headers)
-        if r.status_code == 204:
-            deleted += 1
-    
+    deleted, _ = delete_records_bulk("ingredients", [ing["id"] for ing in ingredients])
     return deleted
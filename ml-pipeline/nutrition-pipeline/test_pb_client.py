@@ -0,0 +1,78 @@
+import unittest
+from unittest import mock
+
+import requests
+
+import pb_client
+
+
+def _response(status):
+    r = requests.Response()
+    r.status_code = status
+    return r
+
+
+class InsertIngredientsBulkTest(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(pb_client, "_batch_supported", True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_batch_disabled_reports_failed_row_without_raising(self):
+        rows = [{"name": "eggs"}, {"name": "toast"}, {"name": "coffee"}]
+        inserted = [{"id": "a", "name": "eggs"}, requests.HTTPError("400"), {"id": "c", "name": "coffee"}]
+
+        with mock.patch.object(pb_client, "_request", return_value=_response(403)) as batch, \
+                mock.patch.object(pb_client, "insert_ingredient", side_effect=inserted) as insert:
+            created, failed = pb_client.insert_ingredients_bulk(rows)
+
+        self.assertEqual(batch.call_count, 1)
+        self.assertEqual(insert.call_count, 3)
+        self.assertEqual([rec["id"] for rec in created], ["a", "c"])
+        self.assertEqual([(row["name"], type(e)) for row, e in failed], [("toast", requests.HTTPError)])
+
+    def test_batch_disabled_is_remembered(self):
+        with mock.patch.object(pb_client, "_request", return_value=_response(403)) as batch, \
+                mock.patch.object(pb_client, "insert_ingredient", side_effect=lambda ing: ing):
+            pb_client.insert_ingredients_bulk([{"name": "eggs"}])
+            pb_client.insert_ingredients_bulk([{"name": "toast"}])
+
+        self.assertEqual(batch.call_count, 1)
+
+    def test_chunks_are_capped_at_server_limit(self):
+        rows = [{"name": f"item {i}"} for i in range(120)]
+
+        def batch_ok(method, url, json):
+            r = _response(200)
+            r._content = pb_client.json.dumps(
+                [{"status": 200, "body": req["body"]} for req in json["requests"]]
+            ).encode()
+            return r
+
+        with mock.patch.object(pb_client, "_request", side_effect=batch_ok) as batch:
+            created, failed = pb_client.insert_ingredients_bulk(rows, chunk_size=len(rows))
+
+        sizes = [len(call.kwargs["json"]["requests"]) for call in batch.call_args_list]
+        self.assertEqual(sizes, [50, 50, 20])
+        self.assertEqual(created, rows)
+        self.assertEqual(failed, [])
+
+
+class DeleteRecordsBulkTest(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(pb_client, "_batch_supported", False)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_reports_records_that_failed_to_delete(self):
+        responses = [_response(204), _response(404), _response(204)]
+
+        with mock.patch.object(pb_client, "_request", side_effect=responses):
+            deleted, failed = pb_client.delete_records_bulk("ingredients", ["a", "b", "c"])
+
+        self.assertEqual(deleted, 2)
+        self.assertEqual(failed, [("b", 404)])
+
+
+if __name__ == "__main__":
+    unittest.main()
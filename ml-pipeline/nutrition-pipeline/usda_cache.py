@@ -0,0 +1,72 @@
+"""
+Persistent cache for USDA FoodData Central lookups.
+
+Food logs repeat the same ingredients constantly ("eggs", "coffee", "rice"),
+so lookup results are stored in a small SQLite file keyed by the normalized
+ingredient name. Repeat ingredients skip the network call across runs, which
+also keeps us well under the USDA API rate limit.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from pathlib import Path
+
+CACHE_PATH = Path(os.getenv("USDA_CACHE_PATH") or Path(__file__).parent / ".usda_cache.sqlite")
+MAX_AGE_DAYS = 90
+COMPRESS_OVER_BYTES = 512
+
+_conn = None
+_lock = threading.Lock()
+
+
+def normalize_name(name: str) -> str:
+    """Cache key for an ingredient name: lowercased, whitespace collapsed."""
+    return " ".join((name or "").lower().split())
+
+
+def _connection():
+    global _conn
+    if _conn is None:
+        _conn = sqlite3.connect(CACHE_PATH, check_same_thread=False)
+        _conn.execute("PRAGMA journal_mode=WAL")
+        _conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache (name TEXT PRIMARY KEY, payload BLOB, ts INTEGER)"
+        )
+    return _conn
+
+
+def get(name: str):
+    """
+    Look up a cached result.
+    Returns (hit, value) - value may be None for cached "no valid match".
+    """
+    cutoff = int(time.time()) - MAX_AGE_DAYS * 86400
+    with _lock:
+        row = _connection().execute(
+            "SELECT payload FROM cache WHERE name = ? AND ts >= ?", (name, cutoff)
+        ).fetchone()
+    if row is None:
+        return False, None
+
+    payload = row[0]
+    if payload[:1] == b"\x78":  # zlib header; plain JSON never starts with "x"
+        payload = zlib.decompress(payload)
+    return True, json.loads(payload)
+
+
+def put(name: str, value):
+    """Store a lookup result (a dict, or None for no valid match)."""
+    payload = json.dumps(value).encode("utf-8")
+    if len(payload) > COMPRESS_OVER_BYTES:
+        payload = zlib.compress(payload)
+    with _lock:
+        conn = _connection()
+        conn.execute(
+            "INSERT OR REPLACE INTO cache (name, payload, ts) VALUES (?, ?, ?)",
+            (name, payload, int(time.time())),
+        )
+        conn.commit()
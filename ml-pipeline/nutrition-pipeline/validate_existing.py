@@ -3,9 +3,8 @@
 import os
 import sys
 from dotenv import load_dotenv
-from pb_client import get_token, PB_URL, fetch_all_ingredients
-from lookup_usda import validate_usda_match, extract_macros
-import requests
+from pb_client import fetch_all_ingredients, delete_records_bulk
+from lookup_usda import validate_usda_match, ingredient_macros
 
 load_dotenv()
 
@@ -17,9 +16,6 @@ def validate_existing_ingredients(dry_run=True, since_date=None):
         dry_run: If True, only report issues without deleting
         since_date: Only check ingredients after this date (ISO format)
     """
-    token = get_token()
-    headers = {"Authorization": f"Bearer {token}"}
-    
     print("📦 Fetching all ingredients...")
     all_ingredients = fetch_all_ingredients()
     
@@ -39,11 +35,11 @@ def validate_existing_ingredients(dry_run=True, since_date=None):
         if ing.get("source") != "usda":
             continue
         
-        nutrition = ing.get("nutrition", [])
-        if not isinstance(nutrition, list) or not nutrition:
+        nutrition = ing["nutrition"]
+        if not nutrition:
             continue
         
-        macros = extract_macros(nutrition)
+        macros = ingredient_macros(ing)
         ingredient_name = ing.get("name", "")
         matched_name = ing.get("rawUSDA", {}).get("name", "") or "unknown"
         
@@ -73,14 +69,9 @@ def validate_existing_ingredients(dry_run=True, since_date=None):
     
     if not dry_run:
         print(f"\n🗑️  Deleting {len(bad_matches)} bad matches...")
-        deleted = 0
-        for bad in bad_matches:
-            url = f"{PB_URL}/api/collections/ingredients/records/{bad['id']}"
-            resp = requests.delete(url, headers=headers)
-            if resp.status_code == 204:
-                deleted += 1
-            else:
-                print(f"  ⚠️  Failed to delete {bad['id']}: {resp.status_code}")
+        deleted, failed = delete_records_bulk("ingredients", [bad["id"] for bad in bad_matches])
+        for record_id, status_code in failed:
+            print(f"  ⚠️  Failed to delete {record_id}: {status_code}")
         
         print(f"✅ Deleted {deleted}/{len(bad_matches)} bad matches")
     else:
@@ -97,8 +88,9 @@ if __name__ == "__main__":
     
     since_date = None
     if args.last_week:
-        from datetime import datetime, timedelta
-        since_date = (datetime.now() - timedelta(days=7)).strftime("%Y-%m-%d")
+        from datetime import datetime, timedelta, timezone
+        # PocketBase timestamps are UTC, so take the cutoff in UTC too
+        since_date = (datetime.now(timezone.utc) - timedelta(days=7)).strftime("%Y-%m-%d")
     elif args.since:
         since_date = args.since
     